@@ -1,168 +1,235 @@
+# Patch blocking stdlib I/O (sockets, ssl, time) before anything else imports it,
+# so Overpass/Groq/SMTP waits yield to other requests under gevent workers
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import sys
+import time
+import queue
+import threading
+import h3
 import joblib
+import orjson
 import requests
 import traceback
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+from cachetools import TTLCache
+from concurrent.futures import Future
+from gevent.pool import Pool
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import smtplib
 from flask_cors import CORS
 
 # Allow imports from root
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 from Src_Code.rag_integration import query_rag
+from Src_Code.tree_inference import CompiledTree
+from tasks import send_email_alert
 
 load_dotenv()
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson's C encoder/decoder"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 CORS(app)
+
+# Independent I/O-bound lookups (RAG, Overpass) run side by side per request as
+# greenlets. Each request holds up to three (RAG, Overpass, email publish), so the
+# default covers Gunicorn's --worker-connections 200 without queueing requests.
+REQUEST_POOL_SIZE = int(os.getenv("REQUEST_POOL_SIZE", "600"))
+REQUEST_POOL = Pool(REQUEST_POOL_SIZE)
 # ================== Load ML Model ==================
 MODEL_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../models/decision_tree_model.pkl"))
 if not os.path.exists(MODEL_PATH):
     raise FileNotFoundError(f"Model not found at {MODEL_PATH}")
 
-model = joblib.load(MODEL_PATH)
+# Read-only mmap: numpy buffers are backed by the page cache and shared between
+# Gunicorn workers (with --preload) instead of copied into each worker's heap
+model = joblib.load(MODEL_PATH, mmap_mode='r')
+# Flattened node arrays walked directly, bypassing sklearn's per-call predict() overhead
+compiled_model = CompiledTree(model)
 print("✅ Model loaded successfully")
 
-# ================== Email Alert ==================
-# ================== Email Alert ==================
-def send_email_alert(to_email, risk, explanation, nextSteps, user_name):
-    try:
-        sender = os.getenv("EMAIL_SENDER")
-        password = os.getenv("EMAIL_PASSWORD")
+# ================== OpenStreetMap Doctor Search ==================
+# Hospitals around a ~0.7 km² H3 cell change on the order of days, so Overpass
+# results are cached per (cell, radius) for 24 h; misses reuse pooled keep-alive connections
+H3_RESOLUTION = 8
+HOSPITAL_CACHE = TTLCache(maxsize=10000, ttl=86400)
+_hospital_cache_lock = threading.Lock()
+# Cache misses past OVERPASS_POOL_SIZE wait for a free keep-alive connection
+# (pool_block) instead of opening throwaway ones that urllib3 then discards
+OVERPASS_POOL_SIZE = int(os.getenv("OVERPASS_POOL_SIZE", "16"))
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=OVERPASS_POOL_SIZE,
+    pool_block=True,
+    # Overpass queries are read-only, so POSTs are safe to retry; a timed-out read is not
+    max_retries=Retry(total=2, read=0, backoff_factor=0.3, status_forcelist=(429, 502, 503, 504),
+                      allowed_methods=None),
+))
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _haversine_km(lat0, lon0, lats, lons):
+    """Great-circle distances (km) from one point to arrays of points, all in degrees"""
+    lat0, lon0 = np.radians(lat0), np.radians(lon0)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat0) * 0.5) ** 2 + np.cos(lat0) * np.cos(lats) * np.sin((lons - lon0) * 0.5) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _hospitals_in_cell(lat, lon, radius_m):
+    """All hospitals Overpass knows around the H3 cell containing (lat, lon); cached"""
+    cell = h3.latlng_to_cell(lat, lon, H3_RESOLUTION)
+    key = (cell, radius_m)
+    with _hospital_cache_lock:
+        cached = HOSPITAL_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    # Query around the cell centre so every point in the cell shares one result
+    lat_c, lon_c = h3.cell_to_latlng(cell)
+    query = f"""
+    [out:json];
+    (
+      node["amenity"="hospital"](around:{radius_m},{lat_c},{lon_c});
+      way["amenity"="hospital"](around:{radius_m},{lat_c},{lon_c});
+      relation["amenity"="hospital"](around:{radius_m},{lat_c},{lon_c});
+    );
+    out center;
+    """
+    response = _HTTP.post("https://overpass-api.de/api/interpreter", data={"data": query}, timeout=20)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+
+    hospitals = []
+    for element in data.get("elements", []):
+        tags = element.get("tags", {})
+        lat_h = element.get("lat") or element.get("center", {}).get("lat")
+        lon_h = element.get("lon") or element.get("center", {}).get("lon")
+        if lat_h is None or lon_h is None:
+            continue
+        hospitals.append({
+            "name": tags.get("name", "Unnamed Hospital"),
+            "type": tags.get("hospital:type", "General"),
+            "address": tags.get("address", tags.get("addr:street", "N/A")),
+            "latitude": lat_h,
+            "longitude": lon_h
+        })
+
+    # Overpass reports query timeouts and memory limits as HTTP 200 with a "remark"
+    # and empty or partial elements; serve that result once but don't cache it
+    if data.get("remark"):
+        print("⚠️ Overpass remark, not caching:", data["remark"])
+        return hospitals
 
-        risk_colors = {
-            "Good": ("#4CAF50", "🟢"),
-            "Fair": ("#FFC107", "🟠"),
-            "Bad": ("#F44336", "🔴")
-        }
-        color, emoji = risk_colors.get(risk, ("#9E9E9E", "⚪"))
-        subject = f"{emoji} Smart Health Alert: {risk} Risk Detected"
-
-        def shorten_text(text, limit=400):
-            return text[:limit] + "..." if len(text) > limit else text
-        
-        print("Explanation content:", explanation)
-        print("Preparing email content...")
-
-        # FIX: Handle explanation as string, not array
-        if isinstance(explanation, str):
-            # Split the explanation into paragraphs or sentences for better formatting
-            explanation_paragraphs = [p.strip() for p in explanation.split('\n\n') if p.strip()]
-            explanation_html = "".join(f"<li>{shorten_text(p)}</li>" for p in explanation_paragraphs[:3])
-        elif isinstance(explanation, list):
-            explanation_html = "".join(f"<li>{shorten_text(c)}</li>" for c in explanation[:3])
-        else:
-            explanation_html = "<li>No detailed explanation available.</li>"
-
-        # FIX: Handle nextSteps as array properly
-        if isinstance(nextSteps, list):
-            nextSteps_html = "".join(f"<li>{shorten_text(str(s))}</li>" for s in nextSteps[:3])
-        else:
-            nextSteps_html = "<li>Consult a doctor for personalized advice.</li>"
-
-        print("Explanation HTML:", explanation_html)
-
-        # Personalized email body
-        body = f"""
-        <html>
-        <body style="font-family: 'Segoe UI', Arial, sans-serif; margin:0; padding:0; background-color:#f5f7fa;">
-            <div style="max-width:600px; margin:30px auto; background:#fff; border-radius:10px; box-shadow:0 2px 6px rgba(0,0,0,0.1); overflow:hidden;">
-                
-                <div style="background:{color}; color:white; text-align:center; padding:16px 20px; font-size:20px; font-weight:bold;">
-                    {emoji} Health Risk Level: {risk}
-                </div>
-
-                <div style="padding:20px;">
-                    <p>Dear {user_name},</p>
-                    <p>Our system has detected a <strong>{risk}</strong> health risk based on your recent vitals.</p>
-
-                    <h3 style="color:{color}; margin-top:20px;">🧠 Results Explanation</h3>
-                    <ul style="line-height:1.5; color:#333;">
-                        {explanation_html}
-                    </ul>
-
-                    <h3 style="color:{color}; margin-top:20px;">💡 Recommended Next Steps</h3>
-                    <ul style="line-height:1.5; color:#333;">
-                        {nextSteps_html}
-                    </ul>
-
-                    <div style="text-align:center; margin-top:30px;">
-                        <a href="https://your-app-url.com/health-report" target="_blank" 
-                           style="background:{color}; color:white; text-decoration:none; padding:12px 24px; border-radius:6px; font-weight:bold;">
-                           View Full Health Report
-                        </a>
-                    </div>
-
-                    <p style="margin-top:30px; color:#666; font-size:14px;">
-                        Stay safe and healthy,<br>
-                        — <strong>Smart Health Assistant</strong>
-                    </p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-
-        msg = MIMEMultipart("alternative")
-        msg["From"] = sender
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, "html"))
-
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(sender, password)
-            server.send_message(msg)
-
-        print(f"📧 Alert email sent to {to_email}")
+    with _hospital_cache_lock:
+        HOSPITAL_CACHE[key] = hospitals
+    return hospitals
 
-    except Exception as e:
-        print("⚠️ Email send failed:", e)
 
-# ================== OpenStreetMap Doctor Search ==================
-def find_nearby_hospitals(lat, lon, radius_m=5000):
+def find_nearby_hospitals(lat, lon, radius_m=5000, limit=5):
     """
-    Use Overpass API to find nearby hospitals within the specified radius (meters)
+    Use Overpass API to find the nearest hospitals within the specified radius (meters),
+    each with its real distance from (lat, lon)
     """
     try:
-        query = f"""
-        [out:json];
-        (
-          node["amenity"="hospital"](around:{radius_m},{lat},{lon});
-          way["amenity"="hospital"](around:{radius_m},{lat},{lon});
-          relation["amenity"="hospital"](around:{radius_m},{lat},{lon});
-        );
-        out center;
-        """
-        response = requests.post("https://overpass-api.de/api/interpreter", data={"data": query}, timeout=20)
-        data = response.json()
-
-        hospitals = []
-        for element in data.get("elements", [])[:5]:  # limit to 5 hospitals
-            tags = element.get("tags", {})
-            name = tags.get("name", "Unnamed Hospital")
-            hospital_type = tags.get("hospital:type", "General")
-            address = tags.get("address", tags.get("addr:street", "N/A"))
-            lat_h = element.get("lat") or element.get("center", {}).get("lat")
-            lon_h = element.get("lon") or element.get("center", {}).get("lon")
-            hospitals.append({
-                "name": name,
-                "type": hospital_type,
-                "address": address,
-                "latitude": lat_h,
-                "longitude": lon_h
-            })
-
-        return hospitals
+        lat, lon = float(lat), float(lon)
+        hospitals = _hospitals_in_cell(lat, lon, radius_m)
+        if not hospitals:
+            return []
+
+        n = len(hospitals)
+        lats = np.fromiter((h["latitude"] for h in hospitals), float, count=n)
+        lons = np.fromiter((h["longitude"] for h in hospitals), float, count=n)
+        distances = _haversine_km(lat, lon, lats, lons)
+
+        nearest = np.argsort(distances)[:limit]
+        return [
+            {**hospitals[i], "distance_km": round(float(distances[i]), 1)}
+            for i in nearest
+        ]
 
     except Exception as e:
         print("⚠️ Hospital lookup failed:", e)
         return []
-    
+
+
 # ================== Risk Prediction ==================
+class PredictBatcher:
+    """
+    Collects single-row predictions for a short window and runs them as one
+    compiled_model.predict() call, answering each caller through a Future.
+    """
+
+    def __init__(self, predict_fn, window_s=0.005, max_batch=64):
+        self.predict_fn = predict_fn
+        self.window_s = window_s
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, row):
+        # Started lazily so the collector runs in the serving (post-fork) process
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        future = Future()
+        self.queue.put((row, future))
+        return future
+
+    def _run(self):
+        while True:
+            row, future = self.queue.get()
+            rows, futures = [row], [future]
+            deadline = time.monotonic() + self.window_s
+            while len(rows) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row, future = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                rows.append(row)
+                futures.append(future)
+
+            try:
+                preds = self.predict_fn(np.vstack(rows))
+                for f, pred in zip(futures, preds):
+                    f.set_result(pred)
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+
+
+# Micro-batching only pays off under heavy concurrent load; off unless a window is set
+BATCH_WINDOW_MS = float(os.getenv("PREDICT_BATCH_WINDOW_MS", "0"))
+batcher = PredictBatcher(compiled_model.predict, window_s=BATCH_WINDOW_MS / 1000) if BATCH_WINDOW_MS > 0 else None
+
+
 def classify_risk(input_data: dict) -> str:
     try:
         # Encode gender numerically
@@ -177,9 +244,16 @@ def classify_risk(input_data: dict) -> str:
         smoker = int(bool(input_data.get("Smoker", False)))
         diabetes = int(bool(input_data.get("Diabetes", False)))
 
-        features = [gender, age, systolic, diastolic, cholesterol, bmi, smoker, diabetes]
+        # Trees compare on float32, like sklearn
+        features = np.array([gender, age, systolic, diastolic, cholesterol, bmi, smoker, diabetes], dtype=np.float32)
+        # float() accepts "nan"/"inf", and the compiled tree would route them silently
+        if not np.isfinite(features).all():
+            raise ValueError("vitals must be finite numbers")
 
-        pred = model.predict([features])[0]
+        if batcher is not None:
+            return batcher.submit(features).result()
+
+        pred = compiled_model.predict_one(features)
         return pred
 
     except Exception as e:
@@ -187,7 +261,27 @@ def classify_risk(input_data: dict) -> str:
         return "Unknown"
 
 
+# ================== Email Alert ==================
+def queue_email_alert(to_email, risk, explanation, next_steps, user_name):
+    """Hand the alert to a Celery worker; a broker outage is logged, not raised"""
+    try:
+        # Single publish attempt, no retry loop against a dead broker
+        send_email_alert.apply_async(
+            args=(to_email, risk, explanation, next_steps, user_name),
+            retry=False,
+        )
+    except Exception as e:
+        print("⚠️ Email alert could not be queued:", e)
+
+
 # ================== Main Endpoint ==================
+REQUIRED_FIELDS = frozenset({
+    "Name", "Gender", "Age", "Systolic BP", "Diastolic BP",
+    "Cholesterol", "BMI", "Smoker", "Diabetes",
+    "Email", "Latitude", "Longitude"
+})
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
     try:
@@ -195,26 +289,28 @@ def analyze():
         if not data:
             return jsonify({"error": "No JSON provided"}), 400
 
-        required = [
-            "Name", "Gender", "Age", "Systolic BP", "Diastolic BP",
-            "Cholesterol", "BMI", "Smoker", "Diabetes",
-            "Email", "Latitude", "Longitude"
-        ]
-        missing = [r for r in required if r not in data]
+        missing = REQUIRED_FIELDS.difference(data)
         if missing:
-            return jsonify({"error": "Missing fields", "missing": missing}), 400
+            return jsonify({"error": "Missing fields", "missing": sorted(missing)}), 400
 
         user_name = data["Name"]
         risk = classify_risk(data)
-        rag_result = query_rag(data, risk)
+
+        # Hospital lookup only needs the location, so it overlaps with the RAG call
+        g_hospitals = REQUEST_POOL.spawn(find_nearby_hospitals, data["Latitude"], data["Longitude"])
+        g_rag = REQUEST_POOL.spawn(query_rag, data, risk)
+
+        rag_result = g_rag.get()
         explanation = rag_result.get("explanation", [])
         diagnosis = rag_result.get("diagnosis", [])
         next_steps = rag_result.get("nextSteps", [])
 
-        hospitals = find_nearby_hospitals(data["Latitude"], data["Longitude"])
+        hospitals = g_hospitals.get()
 
         if risk == "Bad":
-            send_email_alert(data["Email"], risk, explanation, next_steps, user_name)
+            # Published in the background: even a refused broker connection takes
+            # seconds to report, and it must not delay or fail the analysis
+            REQUEST_POOL.spawn(queue_email_alert, data["Email"], risk, explanation, next_steps, user_name)
 
         response = {
             "name": user_name,
@@ -241,4 +337,9 @@ def test():
     return jsonify({"status": "success", "message": "Test route is working", "timestamp": "2024"})
 
 if __name__ == "__main__":
+    # Development server only; in production run from the project root with
+    #   gunicorn -k gevent -w 4 --worker-connections 200 --preload Deployment.app:app
+    # The ONNX session and Chroma client open lazily in each worker. Build rag_db once
+    # beforehand so workers don't all scrape and write it concurrently on first request:
+    #   python -c "from Src_Code.rag_integration import init_rag; init_rag()"
     app.run(debug=True, port=5000)
\ No newline at end of file
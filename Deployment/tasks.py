@@ -0,0 +1,188 @@
+import os
+import smtplib
+import threading
+from functools import lru_cache
+from celery import Celery, shared_task
+from dotenv import load_dotenv
+from jinja2 import Environment
+from markupsafe import escape
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+load_dotenv()
+
+# Run workers from the Deployment folder:
+#   celery -A tasks worker --concurrency=8
+celery = Celery("smart_health", broker=os.getenv("BROKER_URL"))
+
+
+# ================== SMTP Connection ==================
+# One authenticated connection per worker process, reused across alerts
+_smtp_lock = threading.Lock()
+_smtp_conn = None
+
+
+def _get_smtp(reconnect=False):
+    """Return a live SMTP connection, reconnecting if the server dropped it.
+    Must be called with _smtp_lock held."""
+    global _smtp_conn
+    if _smtp_conn is not None and not reconnect:
+        try:
+            _smtp_conn.noop()
+            return _smtp_conn
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    if _smtp_conn is not None:
+        try:
+            _smtp_conn.close()
+        except Exception:
+            pass
+        _smtp_conn = None
+
+    conn = smtplib.SMTP("smtp.gmail.com", 587)
+    conn.starttls()
+    conn.login(os.getenv("EMAIL_SENDER"), os.getenv("EMAIL_PASSWORD"))
+    _smtp_conn = conn
+    return conn
+
+
+# ================== Email Template ==================
+RISK_COLORS = {
+    "Good": ("#4CAF50", "🟢"),
+    "Fair": ("#FFC107", "🟠"),
+    "Bad": ("#F44336", "🔴")
+}
+DEFAULT_RISK_COLOR = ("#9E9E9E", "⚪")
+
+
+def shorten_text(text, limit=400):
+    return text[:limit] + "..." if len(text) > limit else text
+
+
+EMAIL_TEMPLATE_STR = """
+<html>
+<body style="font-family: 'Segoe UI', Arial, sans-serif; margin:0; padding:0; background-color:#f5f7fa;">
+    <div style="max-width:600px; margin:30px auto; background:#fff; border-radius:10px; box-shadow:0 2px 6px rgba(0,0,0,0.1); overflow:hidden;">
+
+        <div style="background:{{ color }}; color:white; text-align:center; padding:16px 20px; font-size:20px; font-weight:bold;">
+            {{ emoji }} Health Risk Level: {{ risk }}
+        </div>
+
+        <div style="padding:20px;">
+            <p>Dear {{ user_name }},</p>
+            <p>Our system has detected a <strong>{{ risk }}</strong> health risk based on your recent vitals.</p>
+
+            <h3 style="color:{{ color }}; margin-top:20px;">🧠 Results Explanation</h3>
+            <ul style="line-height:1.5; color:#333;">
+                {% for item in explanation %}<li>{{ item | shorten }}</li>{% else %}<li>No detailed explanation available.</li>{% endfor %}
+            </ul>
+
+            <h3 style="color:{{ color }}; margin-top:20px;">💡 Recommended Next Steps</h3>
+            <ul style="line-height:1.5; color:#333;">
+                {% for step in next_steps %}<li>{{ step | shorten }}</li>{% else %}<li>Consult a doctor for personalized advice.</li>{% endfor %}
+            </ul>
+
+            <div style="text-align:center; margin-top:30px;">
+                <a href="https://your-app-url.com/health-report" target="_blank"
+                   style="background:{{ color }}; color:white; text-decoration:none; padding:12px 24px; border-radius:6px; font-weight:bold;">
+                   View Full Health Report
+                </a>
+            </div>
+
+            <p style="margin-top:30px; color:#666; font-size:14px;">
+                Stay safe and healthy,<br>
+                — <strong>Smart Health Assistant</strong>
+            </p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+# Compiled once at import; autoescape keeps LLM output and user names from injecting HTML
+_jinja_env = Environment(autoescape=True)
+_jinja_env.filters["shorten"] = shorten_text
+EMAIL_TEMPLATE = _jinja_env.from_string(EMAIL_TEMPLATE_STR)
+
+# Rendered bodies are shared between patients (the bucketed RAG cache hands many of
+# them identical results), so the name goes in after rendering via this placeholder
+_USER_NAME_SLOT = "__USER_NAME__"
+
+
+@lru_cache(maxsize=1024)
+def _render_email(risk: str, explanation: tuple, next_steps: tuple) -> str:
+    color, emoji = RISK_COLORS.get(risk, DEFAULT_RISK_COLOR)
+    return EMAIL_TEMPLATE.render(
+        color=color,
+        emoji=emoji,
+        risk=risk,
+        user_name=_USER_NAME_SLOT,
+        explanation=explanation,
+        next_steps=next_steps,
+    )
+
+
+# ================== Email Alert ==================
+def _is_transient(e):
+    """Dropped connections, network errors and 4xx SMTP replies; 5xx (bad recipient,
+    rejected sender, wrong credentials) will fail the same way on every retry"""
+    if isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        # Raised only when every recipient was refused; codes are per recipient
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, OSError)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def send_email_alert(self, to_email, risk, explanation, nextSteps, user_name):
+    try:
+        sender = os.getenv("EMAIL_SENDER")
+
+        _, emoji = RISK_COLORS.get(risk, DEFAULT_RISK_COLOR)
+        subject = f"{emoji} Smart Health Alert: {risk} Risk Detected"
+
+        print("Explanation content:", explanation)
+        print("Preparing email content...")
+
+        # Handle explanation as string (split into paragraphs) or as array
+        if isinstance(explanation, str):
+            explanation_items = tuple(p.strip() for p in explanation.split('\n\n') if p.strip())[:3]
+        elif isinstance(explanation, list):
+            explanation_items = tuple(str(c) for c in explanation[:3])
+        else:
+            explanation_items = ()
+
+        next_steps = tuple(str(s) for s in nextSteps[:3]) if isinstance(nextSteps, list) else ()
+
+        # Personalized email body
+        body = _render_email(risk, explanation_items, next_steps).replace(
+            _USER_NAME_SLOT, str(escape(user_name)))
+
+        msg = MIMEMultipart("alternative")
+        msg["From"] = sender
+        msg["To"] = to_email
+        msg["Subject"] = subject
+        msg.attach(MIMEText(body, "html"))
+
+        with _smtp_lock:
+            conn = _get_smtp()
+            try:
+                conn.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Dropped between the liveness check and the send: reconnect once
+                _get_smtp(reconnect=True).send_message(msg)
+
+        print(f"📧 Alert email sent to {to_email}")
+
+    except Exception as e:
+        if not _is_transient(e):
+            print("⚠️ Email send failed:", e)
+            return
+        # Transient SMTP/network failure: let the worker try again later
+        print("⚠️ Email send failed, retrying:", e)
+        raise self.retry(exc=e)
+
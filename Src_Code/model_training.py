@@ -92,7 +92,8 @@ class ModelTrainer:
     def save_model(self, model_name, file_path):
         """Save trained model to file"""
         if model_name in self.models:
-            joblib.dump(self.models[model_name], file_path)
+            # Uncompressed so the API can load it with mmap_mode='r'
+            joblib.dump(self.models[model_name], file_path, compress=0)
             print(f"Model saved to {file_path}")
         else:
             print(f"Model {model_name} not found!")
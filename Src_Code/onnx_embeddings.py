@@ -0,0 +1,90 @@
+# src_codes/onnx_embeddings.py
+
+import os
+import threading
+import numpy as np
+import onnxruntime as ort
+from langchain_core.embeddings import Embeddings
+from transformers import AutoTokenizer
+
+MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def export_quantized_model(model_id, export_dir, quantized_path):
+    """Export a sentence-transformer to ONNX, then quantize its weights to int8"""
+    # Only needed for the one-time export, not for serving
+    from optimum.exporters.onnx import main_export
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    # Plain transformers export: with sentence-transformers installed optimum would
+    # otherwise export token_embeddings/sentence_embedding instead of last_hidden_state
+    main_export(model_id, output=export_dir, task="feature-extraction", library_name="transformers")
+    quantize_dynamic(os.path.join(export_dir, "model.onnx"), quantized_path, weight_type=QuantType.QInt8)
+
+
+class OnnxMiniLMEmbeddings(Embeddings):
+    """
+    all-MiniLM-L6-v2 served by ONNX Runtime with int8 weights.
+    Mean-pooled, L2-normalized sentence vectors, like the sentence-transformers model.
+    """
+
+    def __init__(self, model_id=MODEL_ID, model_dir="minilm_onnx", batch_size=128, max_length=256):
+        quantized_path = os.path.join(model_dir, "minilm-int8.onnx")
+        if not os.path.exists(quantized_path):
+            print("🔧 Exporting embedding model to ONNX int8...")
+            export_quantized_model(model_id, model_dir, quantized_path)
+
+        self.quantized_path = quantized_path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        # main_export saves the tokenizer next to the model, so startup stays offline
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self._lock = threading.Lock()
+        # One InferenceSession per process, keyed by pid. Sessions inherited from a
+        # parent (e.g. a preloading Gunicorn master) are left alone, never used or freed.
+        self._sessions = {}
+
+    def _session(self):
+        """
+        InferenceSession for the current process, created on first use.
+        ORT's intra-op thread pool does not survive fork(), so it is never shared.
+        """
+        pid = os.getpid()
+        with self._lock:
+            session = self._sessions.get(pid)
+            if session is None:
+                options = ort.SessionOptions()
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session = ort.InferenceSession(self.quantized_path, options, providers=["CPUExecutionProvider"])
+                self._sessions[pid] = session
+                print(f"✅ ONNX embedding model loaded (pid {pid})")
+        return session
+
+    def encode(self, texts):
+        """Return a (len(texts), 384) float32 array of normalized embeddings"""
+        session = self._session()
+        input_names = {i.name for i in session.get_inputs()}
+        # Exports made through the sentence-transformers config name the same
+        # per-token states token_embeddings
+        output_names = {o.name for o in session.get_outputs()}
+        output = "last_hidden_state" if "last_hidden_state" in output_names else "token_embeddings"
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            encoded = self.tokenizer(batch, padding=True, truncation=True,
+                                     max_length=self.max_length, return_tensors="np")
+            feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in input_names}
+            hidden = session.run([output], feeds)[0]
+
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.append(pooled.astype(np.float32))
+
+        return np.vstack(vectors) if vectors else np.empty((0, 384), dtype=np.float32)
+
+    def embed_documents(self, texts):
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text])[0].tolist()
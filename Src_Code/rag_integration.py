@@ -1,26 +1,40 @@
 # src_codes/rag_integration.py
 
 import os
+import json
+import time
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from langchain.document_loaders import WebBaseLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain_groq import ChatGroq
 from langchain.chains import RetrievalQA
+from langchain_core.messages import HumanMessage, SystemMessage
 import re
+from functools import lru_cache
+from Src_Code.onnx_embeddings import OnnxMiniLMEmbeddings
+from Src_Code.semantic_cache import SemanticCache
 
 load_dotenv()
 
+# Shared by the vector DB and the semantic cache. all-MiniLM-L6-v2 runs on ONNX
+# Runtime with int8 weights; large batches let the whole knowledge base be
+# encoded in a few forward passes
+embeddings = OnnxMiniLMEmbeddings(batch_size=128)
+
 # ================== Initialize RAG once ==================
+RAG_DB_DIR = "rag_db"
+
+
 def init_rag():
     """Build or load vector DB from WHO/CDC health pages"""
-    persist_dir = "rag_db"
+    persist_dir = RAG_DB_DIR
     if os.path.exists(persist_dir):
         print("✅ Loading existing Chroma DB...")
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        vectordb = Chroma(persist_directory=persist_dir, embedding_function=embeddings)
-        return vectordb.as_retriever(search_kwargs={"k": 5})
+        return Chroma(persist_directory=persist_dir, embedding_function=embeddings)
 
     print("🌐 Building RAG knowledge base...")
     web_pages = [
@@ -37,138 +51,268 @@ def init_rag():
         "https://www.mayoclinic.org/tests-procedures/blood-pressure-test/about/pac-20393098"
     ]
 
+    # Pages are fetched concurrently; startup waits for the slowest one, not the sum
     web_docs = []
-    for url in web_pages:
-        loader = WebBaseLoader(url)
-        web_docs.extend(loader.load())
+    with ThreadPoolExecutor(max_workers=len(web_pages)) as pool:
+        for docs in pool.map(lambda url: WebBaseLoader(url).load(), web_pages):
+            web_docs.extend(docs)
 
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
     chunks = text_splitter.split_documents(web_docs)
 
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    # One call with every chunk so they are embedded in batches, not one by one
     vectordb = Chroma.from_documents(chunks, embedding=embeddings, persist_directory=persist_dir)
     vectordb.persist()
     print("✅ Vector DB created successfully")
 
-    return vectordb.as_retriever(search_kwargs={"k": 5})
+    return vectordb
 
 
-# Initialize retriever globally (only once)
-retriever = init_rag()
-groq = ChatGroq(
-    groq_api_key=os.getenv("GROQ_API_KEY"),
-    model="llama-3.1-8b-instant",
-    temperature=0.3
-)
+def build_kb_context(vectordb, max_chars):
+    """
+    Concatenate every stored chunk into one pinned context (Cache-Augmented Generation).
+    Returns None when the knowledge base is too large for the model's window.
+    """
+    chunks = list(dict.fromkeys(vectordb.get(include=["documents"])["documents"]))
+    kb_context = "\n\n".join(chunks)
+    if len(kb_context) > max_chars:
+        print(f"⚠️ Knowledge base is {len(kb_context)} chars, over the {max_chars} limit; using retrieval")
+        return None
+    print(f"✅ Pinned {len(chunks)} knowledge base chunks as LLM context "
+          f"({len(kb_context)} chars, ~{len(kb_context) // 4} tokens)")
+    return kb_context
 
-qa_chain = RetrievalQA.from_chain_type(
-    llm=groq,
-    chain_type="stuff",
-    retriever=retriever,
-    return_source_documents=False
+
+# The WHO/CDC knowledge base is small and static, so it is sent whole with every
+# question instead of searched per query. ~4 chars/token: 400k chars stays well
+# inside llama-3.1-8b-instant's 128k-token window alongside the prompt and answer.
+KB_CONTEXT_MAX_CHARS = int(os.getenv("KB_CONTEXT_MAX_CHARS", "400000"))
+KB_PROMPT_PREFIX = (
+    "Use the following pieces of context to answer the user's question. "
+    "If you don't know the answer, just say that you don't know, don't try to make up an answer.\n"
+    "----------------\n"
 )
 
+_rag_lock = threading.Lock()
+_rag_state = {}
+
+
+def get_rag():
+    """
+    Chroma client, LLM, retrieval chain and pinned KB prompt for the current process.
+    Created on first use per pid, so a preloading Gunicorn master never forks an open
+    Chroma (SQLite) client or LLM HTTP client into its workers.
+    """
+    pid = os.getpid()
+    with _rag_lock:
+        state = _rag_state.get(pid)
+        if state is None:
+            vectordb = init_rag()
+            groq = ChatGroq(
+                groq_api_key=os.getenv("GROQ_API_KEY"),
+                model="llama-3.1-8b-instant",
+                temperature=0.3,
+                # JSON mode: the reply is a single JSON object, parsed with json.loads
+                model_kwargs={"response_format": {"type": "json_object"}}
+            )
+            qa_chain = RetrievalQA.from_chain_type(
+                llm=groq,
+                chain_type="stuff",
+                retriever=vectordb.as_retriever(search_kwargs={"k": 5}),
+                return_source_documents=False
+            )
+            kb_context = build_kb_context(vectordb, KB_CONTEXT_MAX_CHARS)
+            state = _rag_state[pid] = {
+                "groq": groq,
+                "qa_chain": qa_chain,
+                "kb_system_prompt": KB_PROMPT_PREFIX + kb_context if kb_context is not None else None,
+            }
+        return state
+
+
+# Near-duplicate patient profiles reuse a previous answer instead of calling the LLM
+semantic_cache = SemanticCache(embeddings, threshold=0.95)
+atexit.register(semantic_cache.save)
+
+
+# Set once the provider rejects the pinned context for its size (413 / context
+# length): every later request would fail the same way, so this process sticks to
+# vector retrieval instead of paying a rejected call each time
+_pinned_context_rejected = False
+# A 429 is a per-minute token-rate limit, so retrieval is only used until it lifts
+_pinned_context_retry_at = 0.0
+RATE_LIMIT_BACKOFF_S = 60
+
+
+def _is_size_rejection(e):
+    status = getattr(e, "status_code", None)
+    return status == 413 or (status == 400 and "context_length" in str(e))
+
+
+def _retry_after(e):
+    """Seconds to wait after a 429, from its Retry-After header when present"""
+    response = getattr(e, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return RATE_LIMIT_BACKOFF_S
+
 
 # ================== Main RAG Query Function ==================
-def query_rag(patient_data: dict, risk_level: str):
+def _ask_llm(query):
+    """Answer from the pinned knowledge base; fall back to vector retrieval"""
+    global _pinned_context_rejected, _pinned_context_retry_at
+    rag = get_rag()
+    if (rag["kb_system_prompt"] is not None and not _pinned_context_rejected
+            and time.monotonic() >= _pinned_context_retry_at):
+        try:
+            reply = rag["groq"].invoke([SystemMessage(content=rag["kb_system_prompt"]), HumanMessage(content=query)])
+            return reply.content.strip()
+        except Exception as e:
+            if _is_size_rejection(e):
+                _pinned_context_rejected = True
+                print("⚠️ Pinned context too large for the LLM provider, using retrieval from now on:", e)
+            elif getattr(e, "status_code", None) == 429:
+                wait = _retry_after(e)
+                _pinned_context_retry_at = time.monotonic() + wait
+                print(f"⚠️ Pinned context rate-limited, using retrieval for {wait:.0f}s:", e)
+            else:
+                print("⚠️ Pinned-context call failed, falling back to retrieval:", e)
+
+    result = rag["qa_chain"](query)
+    return result.get("result", "").strip()
+
+
+def _bucket(value, width):
+    """Snap a vital to the lower edge of its clinical bucket"""
+    return int(float(value) // width * width)
+
+
+@lru_cache(maxsize=4096)
+def _query_rag_bucketed(gender: int, age_decade: int, bp_bucket: int, dia_bucket: int,
+                        chol_bucket: int, bmi_bucket: int, smoker: int, diabetes: int,
+                        risk_level: str):
     """
-    Takes structured patient data + predicted risk
-    Returns causes and suggestions using the RAG knowledge base.
+    Runs the RAG query for one bucket of vitals.
+    Raises on failure so that errors are never memoized by lru_cache.
     """
+    # Only the vitals are embedded for the semantic cache; the patient's name is
+    # left out of the prompt so a cached answer can be shared between patients
+    vitals = f"""
+    Patient vitals:
+    - Gender: {"Female" if gender == 1 else "Male"}
+    - Age: {age_decade}-{age_decade + 9}
+    - BP: {bp_bucket}-{bp_bucket + 9}/{dia_bucket}-{dia_bucket + 9}
+    - Cholesterol: {chol_bucket}-{chol_bucket + 19}
+    - BMI: {bmi_bucket}-{bmi_bucket + 4.9}
+    - Smoker: {"Yes" if smoker else "No"}
+    - Diabetic: {"Yes" if diabetes else "No"}
+    Predicted Risk: {risk_level}
+    """
+
+    # Categorical fields must match exactly; age, cholesterol and BMI may differ by at
+    # most one bucket. Embedding similarity alone can't tell "Age: 20-29" from "70-79"
+    exact_key = f"{risk_level}|gender={gender}|smoker={smoker}|diabetes={diabetes}|bp={bp_bucket}/{dia_bucket}"
+    buckets = (age_decade // 10, chol_bucket // 20, bmi_bucket // 5)
+    # The cache is best-effort: if it fails, answer from the LLM as if it missed
+    query_vec = None
     try:
-        query = f"""
-        Patient vitals:
-        - Gender: {patient_data.get('Gender')}
-        - Age: {patient_data.get('Age')}
-        - BP: {patient_data.get('Systolic BP')}/{patient_data.get('Diastolic BP')}
-        - Cholesterol: {patient_data.get('Cholesterol')}
-        - BMI: {patient_data.get('BMI')}
-        - Smoker: {patient_data.get('Smoker')}
-        - Diabetic: {patient_data.get('Diabetes')}
-        Predicted Risk: {risk_level}
+        query_vec = semantic_cache.embed(vitals)
+        cached = semantic_cache.lookup(query_vec, exact_key, buckets)
+        if cached is not None:
+            print("✅ Semantic cache hit")
+            return cached
+    except Exception as e:
+        print("⚠️ Semantic cache lookup failed:", e)
 
-        Provide:
-        Your Personal Health Report
-        Hello {patient_data.get('Name')}, this report is designed to help you understand your recent vital signs and what they might mean for your health. Our goal is to give you clear information and practical next steps.
+    query = vitals + """
+    Provide:
+    Your Personal Health Report
+    Hello, this report is designed to help you understand your recent vital signs and what they might mean for your health. Our goal is to give you clear information and practical next steps.
 
-        1. Explanation of Your Results & Risk Level
-        Based on the information we have, your results indicate a Moderate to High Risk that warrants attention.
+    1. Explanation of Your Results & Risk Level
+    Based on the information we have, your results indicate a Moderate to High Risk that warrants attention.
 
-        In simple terms, your body is showing signs of working harder than it should to pump blood throughout your body. We see this primarily in your elevated blood pressure. When this is consistently high, it can put extra strain on your heart and blood vessels over time. We have categorized your risk as moderate to high because addressing this now is important for protecting your long-term health.
+    In simple terms, your body is showing signs of working harder than it should to pump blood throughout your body. We see this primarily in your elevated blood pressure. When this is consistently high, it can put extra strain on your heart and blood vessels over time. We have categorized your risk as moderate to high because addressing this now is important for protecting your long-term health.
 
-        2. What This Could Mean (Possible Diagnosis)
-        It's important to remember that this is not a formal diagnosis, but a assessment based on your current numbers. The pattern of your vitals is most commonly associated with Primary Hypertension (High Blood Pressure).
+    2. What This Could Mean (Possible Diagnosis)
+    It's important to remember that this is not a formal diagnosis, but a assessment based on your current numbers. The pattern of your vitals is most commonly associated with Primary Hypertension (High Blood Pressure).
 
-        This is a very common condition where the long-term force of blood against your artery walls is high enough that it may eventually cause health problems. The good news is that it is often manageable with lifestyle adjustments and, if needed, medication.
+    This is a very common condition where the long-term force of blood against your artery walls is high enough that it may eventually cause health problems. The good news is that it is often manageable with lifestyle adjustments and, if needed, medication.
 
-        3. Your Suggested Next Steps
-        Your health is a partnership, and there are clear actions we can take together. Here is what we recommend:
+    3. Your Suggested Next Steps
+    Your health is a partnership, and there are clear actions we can take together. Here is what we recommend:
 
-        Schedule a Follow-Up Appointment: Please book an appointment with your primary care provider to discuss these findings in detail. This is the most important next step. They will likely want to check your blood pressure again to confirm the reading.
+    Schedule a Follow-Up Appointment: Please book an appointment with your primary care provider to discuss these findings in detail. This is the most important next step. They will likely want to check your blood pressure again to confirm the reading.
 
-        Monitor at Home: If your provider agrees, you might consider monitoring your blood pressure at home. We can advise you on how to choose a reliable monitor and how to take accurate readings.
+    Monitor at Home: If your provider agrees, you might consider monitoring your blood pressure at home. We can advise you on how to choose a reliable monitor and how to take accurate readings.
 
-        Lifestyle Considerations: There are powerful steps you can take to support your heart health:
+    Lifestyle Considerations: There are powerful steps you can take to support your heart health:
 
-        Diet: Reducing sodium (salt) intake can have a significant positive impact.
+    Diet: Reducing sodium (salt) intake can have a significant positive impact.
 
-        Activity: Incorporating gentle, regular exercise like brisk walking can help strengthen your heart.
+    Activity: Incorporating gentle, regular exercise like brisk walking can help strengthen your heart.
 
-        Stress: Exploring stress-reduction techniques such as deep breathing or meditation can be beneficial.
+    Stress: Exploring stress-reduction techniques such as deep breathing or meditation can be beneficial.
 
-        We are here to support you. Please don't hesitate to reach out if you have any questions or need help scheduling your next appointment. Taking proactive steps now is a powerful way to invest in your future well-being.
-        """
+    We are here to support you. Please don't hesitate to reach out if you have any questions or need help scheduling your next appointment. Taking proactive steps now is a powerful way to invest in your future well-being.
 
-        result = qa_chain(query)
-        answer = result.get("result", "").strip()
-        print(f"✅ RAG response obtained. {answer}" )
-         # --- Pattern-based extraction ---
-        sections = {
-            "explanation": "",
-            "diagnosis": "",
-            "nextSteps": "",
-        }
+    Respond ONLY as JSON:
+    {"explanation": "<section 1 as plain text>", "diagnosis": "<section 2 as plain text>", "nextSteps": ["<one next step>", ...]}
+    """
 
-        patterns = {
-            "explanation": r"Explanation of Your Results.*?(?=\n\s*\*\*?What|2\. What|What This Could|$)",
-            "diagnosis": r"What This Could Mean.*?(?=\n\s*\*\*?Your Suggested|3\. Your|Your Suggested|$)",
-            "nextSteps": r"Your Suggested Next Steps.*?(?=\n\s*\*\*?Additional|4\. Additional|Additional Concerns|$)",
-        }
+    answer = _ask_llm(query)
+    print(f"✅ RAG response obtained. {answer}" )
+    # --- Structured JSON reply (Groq JSON mode) ---
+    parsed = json.loads(answer)
+    explanation = str(parsed.get("explanation", "")).strip()
+    diagnosis = str(parsed.get("diagnosis", "")).strip()
+    steps = parsed.get("nextSteps", [])
+    if isinstance(steps, str):
+        steps = [steps]
+    next_steps = [str(step).strip() for step in steps if str(step).strip()]
 
-        for key, pattern in patterns.items():
-            match = re.search(pattern, answer, re.DOTALL | re.IGNORECASE)
-            if match:
-                text = match.group(0)
-                # remove the heading itself
-                text = re.sub(r"^.*?:?\s*", "", text.split("\n", 1)[-1]).strip()
-                sections[key] = text
-
-        # --- Convert next steps and concerns into list form ---
-        # --- Convert next steps and concerns into list form ---
-        def extract_bullets(text):
-            items = re.findall(r"(?:\*|\+|-)\s*(.+)", text)
-            # Filter out the "being." item and other unwanted short items
-            filtered_items = []
-            for item in items:
-                clean_item = item.strip()
-                # Skip items that are just "being." or other very short non-meaningful text
-                if clean_item and clean_item not in ["being.", "being"] and len(clean_item) > 3:
-                    filtered_items.append(clean_item)
-            return filtered_items if filtered_items else [text] if text else []
-        next_steps = extract_bullets(sections["nextSteps"])
-        # --- Detect risk level from explanation ---
-        risk_match = re.search(r"(High|Moderate|Low)\s*Risk", sections["explanation"], re.IGNORECASE)
-        risk_label = risk_match.group(0).title() if risk_match else risk_level
-    
-        structured_response = {
-            "risk": risk_label,
-            "explanation": sections["explanation"] or "No explanation found.",
-            "diagnosis": sections["diagnosis"] or "No diagnosis found.",
-            "nextSteps": next_steps or ["No steps provided."],
-        }
+    # --- Detect risk level from explanation ---
+    risk_match = re.search(r"(High|Moderate|Low)\s*Risk", explanation, re.IGNORECASE)
+    risk_label = risk_match.group(0).title() if risk_match else risk_level
+
+    structured_response = {
+        "risk": risk_label,
+        "explanation": explanation or "No explanation found.",
+        "diagnosis": diagnosis or "No diagnosis found.",
+        "nextSteps": next_steps or ["No steps provided."],
+    }
 
-        print("✅ Parsed structured response:", structured_response)
-        return structured_response  
+    print("✅ Parsed structured response:", structured_response)
+    if query_vec is not None:
+        try:
+            semantic_cache.add(vitals, query_vec, exact_key, structured_response, buckets)
+        except Exception as e:
+            print("⚠️ Semantic cache insert failed:", e)
+    return structured_response
+
+
+def query_rag(patient_data: dict, risk_level: str):
+    """
+    Takes structured patient data + predicted risk
+    Returns causes and suggestions using the RAG knowledge base.
+    Vitals are bucketed (age decade, 10 mmHg BP, 20 mg/dL cholesterol, 5-point BMI)
+    so patients in the same bucket share one cached answer.
+    """
+    try:
+        gender_str = str(patient_data.get("Gender", "")).lower()
+        result = _query_rag_bucketed(
+            1 if gender_str in ["female", "f"] else 2,
+            _bucket(patient_data.get("Age", 0), 10),
+            _bucket(patient_data.get("Systolic BP", 0), 10),
+            _bucket(patient_data.get("Diastolic BP", 0), 10),
+            _bucket(patient_data.get("Cholesterol", 0), 20),
+            _bucket(patient_data.get("BMI", 0), 5),
+            int(bool(patient_data.get("Smoker", False))),
+            int(bool(patient_data.get("Diabetes", False))),
+            str(risk_level),
+        )
+        return dict(result)
     except Exception as e:
         print("⚠️ RAG query failed:", e)
         return {
@@ -0,0 +1,159 @@
+# src_codes/semantic_cache.py
+
+import os
+import json
+import sqlite3
+import threading
+import faiss
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Persistent semantic cache for RAG answers.
+    A query whose embedding has cosine similarity >= threshold with a cached
+    query reuses the stored answer, but only if both share the same exact key.
+    Fields that change the medical meaning (risk level, gender, smoker, diabetes,
+    BP bucket) go in the key: embeddings of near-identical templated text cannot
+    be trusted to tell "Smoker: Yes" from "Smoker: No". For the same reason,
+    numeric bucket indices (age, cholesterol, BMI) are stored with each entry
+    and a hit must be within `bucket_tolerance` buckets of the query on each.
+
+    Answers and embeddings live in SQLite; a FAISS IndexIDMap keyed by the row id
+    mirrors the embeddings and is written to disk every `save_every` inserts,
+    so the cache survives restarts and redeploys.
+    """
+
+    def __init__(self, embeddings, threshold=0.95, db_path="sem_cache.db",
+                 index_path="sem_cache.faiss", save_every=20, bucket_tolerance=1):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.db_path = db_path
+        self.index_path = index_path
+        self.save_every = save_every
+        self.bucket_tolerance = bucket_tolerance
+        self.lock = threading.Lock()
+        self.conn = None
+        self.index = None
+        self.key_ids = {}
+        self._pid = None
+        self._unsaved = 0
+
+    def _open(self):
+        """
+        Open SQLite and load the FAISS index in the current process.
+        Done lazily (under the lock) so forked workers never share a connection.
+        """
+        if self.conn is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._unsaved = 0
+
+        self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(semantic_cache)")}
+        table_exists = bool(columns)
+        if table_exists and "buckets" not in columns:
+            # Entries from before bucket gating can't be checked against it; drop them
+            self.conn.execute("DROP TABLE semantic_cache")
+            table_exists = False
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS semantic_cache (
+                id INTEGER PRIMARY KEY,
+                query TEXT,
+                exact_key TEXT,
+                buckets JSON,
+                result JSON,
+                embedding BLOB
+            )
+        """)
+        self.conn.commit()
+
+        # An index file without its table (e.g. from an older schema) has ids that
+        # mean nothing here; rebuild from the table instead
+        self.index = None
+        if table_exists and os.path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+
+        # Rows written after the index file was last saved (e.g. by another worker)
+        known = set(faiss.vector_to_array(self.index.id_map).tolist()) if self.index is not None else set()
+        self.key_ids = {}
+        missing = []
+        for row_id, exact_key, buckets, blob in self.conn.execute(
+                "SELECT id, exact_key, buckets, embedding FROM semantic_cache"):
+            self.key_ids.setdefault(exact_key, {})[row_id] = tuple(json.loads(buckets))
+            if row_id not in known:
+                missing.append((row_id, blob))
+        if missing:
+            vecs = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in missing])
+            self._add_to_index(vecs, np.array([row_id for row_id, _ in missing], dtype=np.int64))
+
+        count = self.index.ntotal if self.index is not None else 0
+        print(f"✅ Loaded semantic cache with {count} entries")
+
+    def _add_to_index(self, vecs, ids):
+        if self.index is None:
+            self.index = faiss.IndexIDMap(faiss.IndexFlatIP(vecs.shape[1]))
+        self.index.add_with_ids(vecs, ids)
+
+    def embed(self, text):
+        """Embed and L2-normalize text so inner product equals cosine similarity"""
+        vec = np.asarray(self.embeddings.embed_query(text), dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def _near(self, a, b):
+        return len(a) == len(b) and all(abs(x - y) <= self.bucket_tolerance for x, y in zip(a, b))
+
+    def lookup(self, vec, exact_key, buckets=()):
+        """
+        Return the cached answer for the nearest query with the same exact key and
+        bucket indices within tolerance, or None
+        """
+        with self.lock:
+            self._open()
+            entries = self.key_ids.get(exact_key, {})
+            ids = [row_id for row_id, row_buckets in entries.items() if self._near(row_buckets, buckets)]
+            if self.index is None or not ids:
+                return None
+            # Search only among those entries
+            selector = faiss.IDSelectorBatch(np.array(ids, dtype=np.int64))
+            scores, found = self.index.search(vec, 1, params=faiss.SearchParameters(sel=selector))
+            score, row_id = float(scores[0][0]), int(found[0][0])
+            if row_id < 0 or score < self.threshold:
+                return None
+            row = self.conn.execute(
+                "SELECT result FROM semantic_cache WHERE id = ? AND exact_key = ?",
+                (row_id, exact_key),
+            ).fetchone()
+            return json.loads(row[0]) if row is not None else None
+
+    def add(self, query, vec, exact_key, result, buckets=()):
+        with self.lock:
+            self._open()
+            cur = self.conn.execute(
+                "INSERT INTO semantic_cache (query, exact_key, buckets, result, embedding) VALUES (?, ?, ?, ?, ?)",
+                (query, exact_key, json.dumps(list(buckets)), json.dumps(result), vec.astype(np.float32).tobytes()),
+            )
+            self.conn.commit()
+            self._add_to_index(vec, np.array([cur.lastrowid], dtype=np.int64))
+            self.key_ids.setdefault(exact_key, {})[cur.lastrowid] = tuple(buckets)
+
+            self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self._write_index()
+
+    def _write_index(self):
+        # Write-then-rename so other workers never read a half-written file
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        faiss.write_index(self.index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+        self._unsaved = 0
+
+    def save(self):
+        """Persist the FAISS index to disk (SQLite rows are committed on insert)"""
+        with self.lock:
+            if self.index is None or self._pid != os.getpid() or self._unsaved == 0:
+                return
+            self._write_index()
+        print(f"💾 Semantic cache saved ({self.index.ntotal} entries)")
@@ -0,0 +1,74 @@
+# src_codes/tree_inference.py
+
+import numpy as np
+
+TREE_LEAF = -1
+
+
+class CompiledTree:
+    """
+    Flattened, array-of-nodes version of a fitted sklearn DecisionTreeClassifier.
+    Walks the tree directly instead of going through sklearn's predict()
+    (input validation, dtype coercion, per-call dispatch), with identical results.
+    """
+
+    def __init__(self, model):
+        tree = model.tree_
+        self.classes = np.asarray(model.classes_)
+        self.max_depth = int(tree.max_depth)
+        self.n_features = int(model.n_features_in_)
+
+        # Node arrays for the vectorized batch walk
+        self.left = tree.children_left.astype(np.intp)
+        self.right = tree.children_right.astype(np.intp)
+        self.feature = np.where(self.left == TREE_LEAF, 0, tree.feature).astype(np.intp)
+        self.threshold = tree.threshold.astype(np.float64)
+        self.is_leaf = self.left == TREE_LEAF
+        self.leaf_class = tree.value[:, 0, :].argmax(axis=1)
+
+        # Exact int16 quantization for the batch walk: a value's code is the number
+        # of split thresholds on its feature strictly below it, so for every split
+        # x <= threshold_k  <=>  code(x) <= k, and nodes compare 2-byte codes instead of doubles
+        self.split_points = []
+        self.qthreshold = np.zeros(tree.node_count, dtype=np.int16)
+        for f in range(self.n_features):
+            mask = ~self.is_leaf & (self.feature == f)
+            points = np.unique(self.threshold[mask])
+            self.split_points.append(points)
+            self.qthreshold[mask] = np.searchsorted(points, self.threshold[mask])
+
+        # Plain Python lists are faster than numpy scalar indexing for a single row
+        self._left = self.left.tolist()
+        self._right = self.right.tolist()
+        self._feature = self.feature.tolist()
+        self._threshold = self.threshold.tolist()
+        self._label = [self.classes[c] for c in self.leaf_class]
+
+    def predict_one(self, row):
+        """Predict a single sample (sequence of n_features numbers)"""
+        # Round through float32 exactly like sklearn does before comparing
+        x = np.asarray(row, dtype=np.float32).tolist()
+        left, right, feature, threshold = self._left, self._right, self._feature, self._threshold
+        node = 0
+        while left[node] != TREE_LEAF:
+            node = left[node] if x[feature[node]] <= threshold[node] else right[node]
+        return self._label[node]
+
+    def quantize(self, X):
+        """Map a float batch to per-feature int16 split codes"""
+        X = np.asarray(X, dtype=np.float32)
+        Q = np.empty(X.shape, dtype=np.int16)
+        for f, points in enumerate(self.split_points):
+            Q[:, f] = np.searchsorted(points, X[:, f], side="left")
+        return Q
+
+    def predict(self, X):
+        """Predict a batch; every row advances one level per step without branching"""
+        Q = self.quantize(X)
+        rows = np.arange(Q.shape[0])
+        nodes = np.zeros(Q.shape[0], dtype=np.intp)
+        for _ in range(self.max_depth):
+            go_left = Q[rows, self.feature[nodes]] <= self.qthreshold[nodes]
+            nxt = np.where(go_left, self.left[nodes], self.right[nodes])
+            nodes = np.where(self.is_leaf[nodes], nodes, nxt)
+        return self.classes[self.leaf_class[nodes]]